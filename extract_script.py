@@ -1,44 +1,57 @@
 import sys
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import csv
+import io
 import psycopg2  
 import configparser # Thư viện đọc config
 import os
+import functools
+import types
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILE_PATH = os.path.join(BASE_DIR, 'config.ini')
+MAX_CONCURRENT_JOBS = 8 # Bằng pool_maxsize của HTTP session
 
+DB_SETTING_KEYS = ('host', 'port', 'user', 'password')
+
+@functools.lru_cache(maxsize=1)
 def load_config():
     """
-    Đọc file config.ini 
+    Đọc file config.ini (chỉ 1 lần mỗi tiến trình).
+    Biến môi trường DB_HOST, DB_PORT, DB_USER, DB_PASSWORD được ưu tiên hơn file.
     """
-    if not os.path.exists(CONFIG_FILE_PATH):
-        print(f"LỖI: Không tìm thấy file '{CONFIG_FILE_PATH}'", file=sys.stderr)
-        print(f"Hãy sao chép 'config.ini.template' thành 'config.ini' và điền thông tin CSDL.", file=sys.stderr)
-        sys.exit(1)
-        
     config = configparser.ConfigParser()
     config.read(CONFIG_FILE_PATH)
     
-    if 'database' not in config:
-        print(f"LỖI: File 'config.ini' phải có mục [database]", file=sys.stderr)
+    env_settings = {
+        key: os.environ[f"DB_{key.upper()}"] for key in DB_SETTING_KEYS
+        if f"DB_{key.upper()}" in os.environ
+    }
+    
+    if 'database' not in config and not env_settings:
+        if not os.path.exists(CONFIG_FILE_PATH):
+            print(f"LỖI: Không tìm thấy file '{CONFIG_FILE_PATH}'", file=sys.stderr)
+            print(f"Hãy sao chép 'config.ini.template' thành 'config.ini' và điền thông tin CSDL.", file=sys.stderr)
+        else:
+            print(f"LỖI: File 'config.ini' phải có mục [database]", file=sys.stderr)
         sys.exit(1)
     
-   
-    return dict(config['database'])
-
-
-db_settings = load_config()
+    settings = dict(config['database']) if 'database' in config else {}
+    settings.update(env_settings)
+    # Chỉ đọc, tránh việc sửa nhầm cache dùng chung
+    return types.MappingProxyType(settings)
 
 
 def get_db_config(db_name):
     """
     Lấy thông tin config chung và thêm 'dbname' cụ thể.
     """
-    # Bây giờ db_settings là dict thật, nên lệnh .copy() sẽ hoạt động tốt
-    settings = db_settings.copy()
+    settings = dict(load_config())
     settings['dbname'] = db_name
     return settings
 
@@ -56,17 +69,44 @@ def get_control_connection():
         raise # Ném lỗi ra ngoài để dừng chương trình
 
 
+def create_http_session():
+    """
+    Tạo requests.Session dùng chung (keep-alive, connection pool, tự retry lỗi 5xx/429)
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset({'GET', 'POST'}), # POST lấy token (client_credentials) gửi lại được an toàn
+        raise_on_status=False # Trả về response cuối để raise_for_status() xử lý như cũ
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount('https://', adapter)
+    session.headers.update({'User-Agent': 'opensky-etl/1.0'})
+    return session
+
+
+SESSION = create_http_session()
+
+
+# Cache cấu hình trong tiến trình (giá trị không đổi trong 1 lần chạy ETL)
+_system_config_cache = {}
+_job_config_cache = {}
 
 def get_system_config(conn, config_key):
     """
-    Đọc một cấu hình cụ thể từ bảng 'configuration'
+    Đọc một cấu hình cụ thể từ bảng 'configuration' (có cache)
     """
+    if config_key in _system_config_cache:
+        return _system_config_cache[config_key]
     try:
         with conn.cursor() as cursor:
             sql = "SELECT config_value FROM configuration WHERE config_key = %s"
             cursor.execute(sql, (config_key,))
             row = cursor.fetchone()
             if row:
+                _system_config_cache[config_key] = row[0]
                 return row[0]
             else:
                 raise Exception(f"Không tìm thấy config_key '{config_key}' trong db_control.configuration.")
@@ -86,7 +126,7 @@ def get_access_token(token_url, client_id, client_secret):
             'client_secret': client_secret
         }
         # POST request để lấy token
-        response = requests.post(token_url, data=data, headers={
+        response = SESSION.post(token_url, data=data, headers={
             'Content-Type': 'application/x-www-form-urlencoded'
         })
         
@@ -118,7 +158,7 @@ def call_opensky_api(config, access_token):
         'Authorization': f'Bearer {access_token}'
     }
     
-    response = requests.get(url, params=params, headers=headers)
+    response = SESSION.get(url, params=params, headers=headers)
     response.raise_for_status()
     return response.json()
 
@@ -126,8 +166,11 @@ def call_opensky_api(config, access_token):
 
 def get_job_config(conn, job_name):
     """
-    Đọc cấu hình từ db_control.job_definitions
+    Đọc cấu hình từ db_control.job_definitions (có cache)
     """
+    if job_name in _job_config_cache:
+        return dict(_job_config_cache[job_name])
+
     print(f"Đang đọc cấu hình job '{job_name}' từ CSDL...")
     config = {}
     try:
@@ -143,8 +186,9 @@ def get_job_config(conn, job_name):
                 
                 if row:
                     config = dict(zip(colnames, row))
+                    _job_config_cache[job_name] = config
                     print(f"Đã đọc cấu hình cho job: {job_name}")
-                    return config
+                    return dict(config)
                 else:
                     raise Exception(f"Không tìm thấy job_name '{job_name}' trong job_definitions.")
             else:
@@ -188,6 +232,26 @@ def log_job_end(conn, log_id, status, message=None):
         print(f"LỖI khi ghi log kết thúc: {e}", file=sys.stderr)
         conn.rollback()
 
+def format_csv_rows(rows):
+    """
+    Ghép các dòng thành 1 chuỗi CSV (giống csv.writer, kết thúc dòng '\\r\\n').
+    Dòng có giá trị cần quote (dấu phẩy, nháy kép, xuống dòng) mới dùng csv.writer.
+    """
+    fallback_buf = io.StringIO()
+    fallback_writer = csv.writer(fallback_buf)
+    lines = []
+    for row in rows:
+        fields = ['' if v is None else str(v) for v in row]
+        line = ','.join(fields)
+        if line.count(',') != len(fields) - 1 or '"' in line or '\n' in line or '\r' in line:
+            fallback_buf.seek(0)
+            fallback_buf.truncate()
+            fallback_writer.writerow(row)
+            lines.append(fallback_buf.getvalue())
+        else:
+            lines.append(line + '\r\n')
+    return ''.join(lines)
+
 def save_data_to_csv(json_response, output_dir, job_name):
     """
     Lưu phản hồi JSON (từ API) vào file CSV
@@ -227,10 +291,9 @@ def save_data_to_csv(json_response, output_dir, job_name):
     ]
     
     try:
-        with open(file_path, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(csv_header)
-            writer.writerows(states_array) # Ghi tất cả các dòng (mảng của mảng)
+        with open(file_path, 'w', newline='', encoding='utf-8', buffering=1 << 20) as f:
+            f.write(','.join(csv_header) + '\r\n')
+            f.write(format_csv_rows(states_array)) # Ghi tất cả các dòng (mảng của mảng) trong 1 lần
             
         return file_path
     except Exception as e:
@@ -238,12 +301,10 @@ def save_data_to_csv(json_response, output_dir, job_name):
         raise e
 
 
-def main():
-    if len(sys.argv) < 2:
-        print("Lỗi: Vui lòng cung cấp job_name (ví dụ: python script.py crawl_europe_live_data)", file=sys.stderr)
-        sys.exit(1)
-        
-    job_name = sys.argv[1]
+def run_job(job_name):
+    """
+    Chạy trọn vẹn 1 job extract (mỗi job dùng kết nối db_control riêng)
+    """
     print(f"--- Bắt đầu Bước 1: Extract Job '{job_name}' ---")
 
     conn = None
@@ -291,5 +352,21 @@ def main():
             
     print(f"--- Job '{job_name}' đã chạy xong ---")
 
+
+def main():
+    if len(sys.argv) < 2:
+        print("Lỗi: Vui lòng cung cấp job_name (ví dụ: python script.py crawl_europe_live_data [job_name ...])", file=sys.stderr)
+        sys.exit(1)
+        
+    # Bỏ job_name trùng (giữ thứ tự) để 2 luồng không cùng ghi 1 file CSV / 1 job
+    job_names = list(dict.fromkeys(sys.argv[1:]))
+    if len(job_names) == 1:
+        run_job(job_names[0])
+        return
+
+    # Nhiều job: chạy song song, các request HTTP dùng chung SESSION (connection pool)
+    with ThreadPoolExecutor(max_workers=min(len(job_names), MAX_CONCURRENT_JOBS)) as executor:
+        list(executor.map(run_job, job_names))
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,12 +1,25 @@
 import os
 import sys
+import io
+import csv
+import functools
+import types
 import pandas as pd
+import numpy as np
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import configparser
 import psycopg2
+from psycopg2 import sql as pgsql
 from sqlalchemy import create_engine
 from psycopg2.extras import execute_values
 
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa = None
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 os.chdir(BASE_DIR)
 
@@ -17,22 +30,57 @@ os.makedirs(CLEAN_DATA_DIR, exist_ok=True)
 
 CONFIG_FILE_PATH = os.path.join(BASE_DIR, 'config.ini')
 
-def load_config():
-    if not os.path.exists(CONFIG_FILE_PATH):
-        print(f"LỖI: Không tìm thấy file '{CONFIG_FILE_PATH}'", file=sys.stderr)
-        sys.exit(1)
+RAW_DTYPES = {
+    'icao24': 'string', 'callsign': 'string', 'origin_country': 'string',
+    'time_position': 'float64', 'last_contact': 'float64',
+    'longitude': 'float64', 'latitude': 'float64', 'baro_altitude': 'float64',
+    'on_ground': 'string',
+    'velocity': 'float64', 'true_track': 'float64', 'vertical_rate': 'float64',
+    'sensors': 'string', 'geo_altitude': 'float64', 'squawk': 'string',
+    'spi': 'string', 'position_source': 'Int64'
+}
+
+MAX_WORKERS = 4
+
+WAREHOUSE_TABLE = 'dim_flight_states'
+
+COPY_BUFFER_SIZE = 1 << 20  # Số byte mỗi lần copy_expert đọc và gửi lên server
+
+ARROW_BLOCK_SIZE = 1 << 20  # Số byte pyarrow parse mỗi lần; kích thước chunk vẫn theo chunk_size (số dòng)
+
+DB_SETTING_KEYS = ('host', 'port', 'user', 'password')
+
+@functools.lru_cache(maxsize=1)
+def read_config_file():
     config = configparser.ConfigParser()
     config.read(CONFIG_FILE_PATH)
-    if 'database' not in config:
-        print(f"LỖI: File 'config.ini' phải có mục [database]", file=sys.stderr)
+    return config
+
+@functools.lru_cache(maxsize=1)
+def load_config():
+    # Biến môi trường DB_HOST, DB_PORT, DB_USER, DB_PASSWORD được ưu tiên hơn config.ini
+    config = read_config_file()
+    env_settings = {
+        key: os.environ[f"DB_{key.upper()}"] for key in DB_SETTING_KEYS
+        if f"DB_{key.upper()}" in os.environ
+    }
+    if 'database' not in config and not env_settings:
+        if not os.path.exists(CONFIG_FILE_PATH):
+            print(f"LỖI: Không tìm thấy file '{CONFIG_FILE_PATH}'", file=sys.stderr)
+        else:
+            print(f"LỖI: File 'config.ini' phải có mục [database]", file=sys.stderr)
         sys.exit(1)
     
-    return dict(config['database'])
+    settings = dict(config['database']) if 'database' in config else {}
+    settings.update(env_settings)
+    return types.MappingProxyType(settings)
 
-db_settings = load_config()
+def load_etl_flag(option, default=False):
+    # Cờ tùy chọn trong mục [etl] của config.ini (không bắt buộc)
+    return read_config_file().getboolean('etl', option, fallback=default)
 
 def get_db_config(db_name):
-    settings = db_settings.copy()
+    settings = dict(load_config())
     settings['dbname'] = db_name
     return settings
 
@@ -46,6 +94,16 @@ def get_control_connection():
         print(f"LỖI KẾT NỐI db_control: {e}", file=sys.stderr)
         raise
 
+def get_warehouse_connection():
+    try:
+        conn_settings = get_db_config('db_warehouse')
+        conn = psycopg2.connect(**conn_settings)
+        conn.autocommit = False
+        return conn
+    except Exception as e:
+        print(f"LỖI KẾT NỐI db_warehouse: {e}", file=sys.stderr)
+        raise
+
 def get_staging_engine():
     try:
         conn_settings = get_db_config('db_staging')
@@ -53,12 +111,28 @@ def get_staging_engine():
             f"postgresql+psycopg2://{conn_settings['user']}:{conn_settings['password']}"
             f"@{conn_settings['host']}:{conn_settings['port']}/{conn_settings['dbname']}"
         )
-        engine = create_engine(connection_string)
+        engine = create_engine(connection_string, pool_size=8, max_overflow=4)
         return engine
     except Exception as e:
         print(f"LỖI KẾT NỐI db_staging (engine): {e}", file=sys.stderr)
         raise
 
+_TRUE_SET = frozenset(['true', 'True', 'TRUE', True, 1, '1'])
+
+_NAT_INT64 = np.iinfo(np.int64).min
+_MAX_EPOCH_SECONDS = 9.2e9  # Giới hạn của datetime64[ns] (~năm 2262)
+
+def epoch_seconds_to_datetime(series):
+    secs = pd.to_numeric(series, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    invalid = ~np.isfinite(secs) | (np.abs(secs) > _MAX_EPOCH_SECONDS)
+    nanos = np.rint(np.where(invalid, 0, secs) * 1_000_000_000).astype('int64')
+    nanos[invalid] = _NAT_INT64
+    return pd.Series(nanos.view('datetime64[ns]'), index=series.index)
+
+def parse_bool_column(series):
+    # Giá trị thiếu giữ NULL (không rõ), không bị hiểu thành False
+    return series.isin(_TRUE_SET).astype('boolean').mask(series.isna())
+
 def transform_chunk(chunk_df):
     numeric_cols = ['longitude', 'latitude', 'baro_altitude', 'velocity', 
                     'true_track', 'vertical_rate', 'geo_altitude']
@@ -67,12 +141,11 @@ def transform_chunk(chunk_df):
     
     chunk_df['position_source'] = pd.to_numeric(chunk_df['position_source'], errors='coerce').astype('Int64')
 
-    chunk_df['time_position'] = pd.to_datetime(chunk_df['time_position'], unit='s', errors='coerce')
-    chunk_df['last_contact'] = pd.to_datetime(chunk_df['last_contact'], unit='s', errors='coerce')
+    chunk_df['time_position'] = epoch_seconds_to_datetime(chunk_df['time_position'])
+    chunk_df['last_contact'] = epoch_seconds_to_datetime(chunk_df['last_contact'])
 
-    bool_map = {'true': True, 'false': False}
-    chunk_df['on_ground'] = chunk_df['on_ground'].astype(str).str.lower().map(bool_map)
-    chunk_df['spi'] = chunk_df['spi'].astype(str).str.lower().map(bool_map)
+    chunk_df['on_ground'] = parse_bool_column(chunk_df['on_ground'])
+    chunk_df['spi'] = parse_bool_column(chunk_df['spi'])
     
     final_columns = [
         'load_timestamp', 'file_source', 'icao24', 'callsign', 'origin_country',
@@ -84,11 +157,7 @@ def transform_chunk(chunk_df):
         'spi', 'position_source'
     ]
     
-    for col in final_columns:
-        if col not in chunk_df.columns:
-            chunk_df[col] = None
-            
-    return chunk_df[final_columns]
+    return chunk_df.reindex(columns=final_columns)
 
 def get_processed_files(conn):
     processed_files = set()
@@ -108,27 +177,168 @@ def register_new_files(conn, new_files):
         with conn.cursor() as cursor:
             args_list = [(f,) for f in new_files]
             sql = "INSERT INTO file_log (file_name) VALUES %s ON CONFLICT (file_name) DO NOTHING;"
-            execute_values(cursor, sql, args_list)
+            execute_values(cursor, sql, args_list, template='(%s)', page_size=1000)
         conn.commit()
     except Exception as e:
         print(f"LỖI đăng ký file: {e}")
         conn.rollback()
 
-def update_file_log(conn, file_name, status, row_count=None, msg=None):
+class FileClaimError(Exception):
+    # Lỗi khi nhận file: file chưa thuộc tiến trình này nên không được ghi trạng thái cuối
+    pass
+
+def claim_file(conn, file_name):
+    # Chuyển file NEW -> PROCESSING; SKIP LOCKED để nhiều tiến trình loader chạy song song không xử lý trùng
     try:
         with conn.cursor() as cursor:
             sql = """
-            UPDATE file_log SET 
-                status = %s, row_count = %s, error_message = %s, last_updated = %s 
-            WHERE file_name = %s
+            UPDATE file_log SET status = 'PROCESSING', last_updated = %s
+            WHERE file_name = (
+                SELECT file_name FROM file_log
+                WHERE file_name = %s AND status = 'NEW'
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING file_name
             """
-            cursor.execute(sql, (status, row_count, msg, datetime.now(), file_name))
+            cursor.execute(sql, (datetime.now(), file_name))
+            claimed = cursor.fetchone() is not None
         conn.commit()
-    except Exception as e:
-        print(f"LỖI cập nhật log: {e}")
+        return claimed
+    except Exception:
         conn.rollback()
+        raise
+
+class FileLogBuffer:
+    # Gom các trạng thái CUỐI của file_log, ghi 1 lệnh UPDATE + 1 commit cho mỗi lô.
+    # PROCESSING phải được ghi ngay (claim_file), nếu không một lần chạy bị crash sau khi
+    # COPY staging đã commit sẽ để file ở NEW và lần chạy sau nạp lại trùng dữ liệu.
+    # WAREHOUSE_LOADED: đã nạp thẳng vào warehouse, KHÔNG có DataStaging/clean_*.csv
+    # (cần chạy sql/file_log_warehouse_loaded.sql nếu cột status có CHECK/ENUM)
+    TERMINAL_STATUSES = ('CLEAN_EXPORTED', 'WAREHOUSE_LOADED', 'FAILED')
+
+    def __init__(self, conn, flush_every=50):
+        self.conn = conn
+        self.flush_every = flush_every
+        self.pending = {}
+
+    def add(self, file_name, status, row_count=None, msg=None):
+        if status not in self.TERMINAL_STATUSES:
+            raise ValueError(f"FileLogBuffer chỉ nhận trạng thái cuối, không nhận '{status}'")
+        self.pending[file_name] = (file_name, status, row_count, msg, datetime.now())
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.pending: return True
+        try:
+            with self.conn.cursor() as cursor:
+                sql = """
+                UPDATE file_log AS f SET 
+                    status = v.status, row_count = v.row_count, 
+                    error_message = v.error_message, last_updated = v.last_updated
+                FROM (VALUES %s) AS v(file_name, status, row_count, error_message, last_updated)
+                WHERE f.file_name = v.file_name AND f.status = 'PROCESSING'
+                """
+                execute_values(cursor, sql, list(self.pending.values()),
+                               template="(%s, %s, %s::integer, %s, %s::timestamp)")
+            self.conn.commit()
+            self.pending.clear()
+            return True
+        except Exception as e:
+            # Giữ lại pending để lần flush sau ghi lại, không làm mất trạng thái cuối của file
+            print(f"LỖI cập nhật log: {e}", file=sys.stderr)
+            try:
+                self.conn.rollback()
+            except Exception:
+                pass # Kết nối đã hỏng; pending vẫn còn để báo cáo
+            return False
+
+    def report_unsaved(self):
+        for file_name, status, row_count, msg, _ in self.pending.values():
+            print(f"LỖI: Chưa lưu được trạng thái file_log: {file_name} -> {status} "
+                  f"(row_count={row_count}, error={msg})", file=sys.stderr)
+
+class RawCsvWithMetadata:
+    # File-like cho copy_expert: nối load_timestamp, file_source vào cuối mỗi bản ghi CSV thô.
+    # Tách bản ghi bằng csv.reader (không theo dòng vật lý) để trường có xuống dòng trong dấu nháy vẫn đúng
+    def __init__(self, reader, load_ts, file_name):
+        self.reader = reader
+        self.extra = [load_ts.isoformat(sep=' '), file_name]
+        self.buf = io.StringIO()
+        self.writer = csv.writer(self.buf, lineterminator='\n')
 
-def process_single_file(file_name, staging_engine):
+    def read(self, size=-1):
+        # Chỉ trả về '' khi đã hết file thật sự, vì copy_expert coi '' là EOF
+        self.buf.seek(0)
+        self.buf.truncate()
+        for row in self.reader:
+            if not row: continue # Bỏ qua dòng trống
+            self.writer.writerow(row + self.extra)
+            if size > 0 and self.buf.tell() >= size:
+                break
+        return self.buf.getvalue()
+
+def copy_raw_file_to_staging(cursor, input_path, file_name, load_ts, table_name='raw_flight_states'):
+    with open(input_path, 'r', newline='', encoding='utf-8') as fh:
+        reader = csv.reader(fh)
+        header = next(reader, None)
+        if not header: return
+        cols = header + ['load_timestamp', 'file_source']
+        # Giữ FORMAT csv thay vì BINARY: không phải chuyển kiểu/pack nhị phân từng giá trị bằng Python,
+        # và không phụ thuộc chính xác kiểu cột (int4/int8/float8) của bảng staging
+        sql = pgsql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+            pgsql.Identifier(table_name),
+            pgsql.SQL(', ').join(pgsql.Identifier(col) for col in cols)
+        )
+        cursor.copy_expert(sql.as_string(cursor), RawCsvWithMetadata(reader, load_ts, file_name),
+                           size=COPY_BUFFER_SIZE)
+
+def iter_raw_chunks(input_path, chunk_size):
+    # Ưu tiên bộ đọc CSV streaming đa luồng của pyarrow, không có thì dùng pandas
+    if pa is None:
+        with pd.read_csv(input_path, chunksize=chunk_size, dtype=RAW_DTYPES, engine='c') as reader:
+            yield from reader
+        return
+
+    column_types = {col: pa.type_for_alias(dtype.lower()) for col, dtype in RAW_DTYPES.items()}
+    reader = pa_csv.open_csv(
+        input_path,
+        read_options=pa_csv.ReadOptions(block_size=ARROW_BLOCK_SIZE),
+        convert_options=pa_csv.ConvertOptions(column_types=column_types, strings_can_be_null=True)
+    )
+    # Gom các RecordBatch (chia theo byte) thành chunk đúng chunk_size dòng như nhánh pandas
+    pending, pending_rows = [], 0
+    for batch in reader:
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        while pending_rows >= chunk_size:
+            table = pa.Table.from_batches(pending)
+            yield table.slice(0, chunk_size).to_pandas()
+            rest = table.slice(chunk_size)
+            pending, pending_rows = rest.to_batches(), rest.num_rows
+    if pending_rows:
+        yield pa.Table.from_batches(pending).to_pandas()
+
+def iter_clean_chunks(input_path, file_name, load_ts, chunk_size):
+    for chunk in iter_raw_chunks(input_path, chunk_size):
+        if chunk.empty: continue
+        
+        chunk['load_timestamp'] = load_ts
+        chunk['file_source'] = file_name
+        
+        yield transform_chunk(chunk)
+
+def copy_chunk_to_warehouse(cursor, clean_chunk, buf, table_name=WAREHOUSE_TABLE):
+    # buf được dùng lại giữa các chunk: xóa nội dung cũ thay vì cấp phát StringIO mới
+    buf.seek(0)
+    buf.truncate()
+    clean_chunk.to_csv(buf, index=False, header=False, na_rep='\\N')
+    buf.seek(0)
+    cols = ', '.join(clean_chunk.columns)
+    sql = f"COPY {table_name} ({cols}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+    cursor.copy_expert(sql, buf, size=COPY_BUFFER_SIZE)
+
+def process_single_file(file_name, staging_engine, warehouse_conn=None):
     input_path = os.path.join(RAW_DATA_DIR, file_name)
     output_path = os.path.join(CLEAN_DATA_DIR, f"clean_{file_name}")
     
@@ -137,42 +347,85 @@ def process_single_file(file_name, staging_engine):
     chunk_size = 100000
     total_rows = 0
     is_first_chunk = True
+    load_ts = datetime.now()
     
-    if os.path.exists(output_path):
-        os.remove(output_path)
+    raw_conn = staging_engine.raw_connection()
+    try:
+        with raw_conn.cursor() as cursor:
+            copy_raw_file_to_staging(cursor, input_path, file_name, load_ts)
 
-    with pd.read_csv(input_path, chunksize=chunk_size) as reader:
-        for chunk in reader:
-            if chunk.empty: continue
-            
-            chunk['load_timestamp'] = datetime.now()
-            chunk['file_source'] = file_name
-            
-            chunk.to_sql('raw_flight_states', staging_engine, if_exists='append', index=False)
-            
-            clean_chunk = transform_chunk(chunk)
-            
-            clean_chunk.to_csv(output_path, mode='a', index=False, header=is_first_chunk)
-            
-            total_rows += len(chunk)
-            if is_first_chunk:
-                is_first_chunk = False
+        if warehouse_conn is not None:
+            # Nạp thẳng dữ liệu sạch vào warehouse, không ghi file clean_*.csv
+            copy_buf = io.StringIO()
+            with warehouse_conn.cursor() as wh_cursor:
+                for clean_chunk in iter_clean_chunks(input_path, file_name, load_ts, chunk_size):
+                    copy_chunk_to_warehouse(wh_cursor, clean_chunk, copy_buf)
+                    total_rows += len(clean_chunk)
+        else:
+            with open(output_path, 'w', buffering=1 << 20, newline='', encoding='utf-8') as out_fh:
+                for clean_chunk in iter_clean_chunks(input_path, file_name, load_ts, chunk_size):
+                    clean_chunk.to_csv(out_fh, index=False, header=is_first_chunk)
+                    
+                    total_rows += len(clean_chunk)
+                    if is_first_chunk:
+                        is_first_chunk = False
+        
+        # Hai CSDL khác nhau nên không commit nguyên tử được: commit staging trước, warehouse sau.
+        # Nếu commit warehouse lỗi, file bị đánh dấu FAILED nhưng raw_flight_states đã có dữ liệu của file:
+        # cần xóa thủ công (DELETE FROM raw_flight_states WHERE file_source = <file>) trước khi chạy lại.
+        raw_conn.commit()
+        if warehouse_conn is not None:
+            warehouse_conn.commit()
+    except Exception:
+        raw_conn.rollback()
+        if warehouse_conn is not None:
+            warehouse_conn.rollback()
+        raise
+    finally:
+        raw_conn.close()
                 
     return total_rows
 
+def load_file(file_name, staging_engine, stream_to_warehouse=False):
+    # Mỗi worker nhận file bằng kết nối db_control ngắn hạn riêng
+    try:
+        control_conn = get_control_connection()
+        try:
+            if not claim_file(control_conn, file_name):
+                return None
+        finally:
+            control_conn.close()
+    except Exception as e:
+        raise FileClaimError(str(e)) from e
+
+    if not stream_to_warehouse:
+        return process_single_file(file_name, staging_engine)
+    
+    # Mỗi worker dùng kết nối warehouse riêng
+    warehouse_conn = get_warehouse_connection()
+    try:
+        return process_single_file(file_name, staging_engine, warehouse_conn)
+    finally:
+        warehouse_conn.close()
+
 def main():
     print("--- Bắt đầu Quy trình ---")
     
     control_conn = None
     staging_engine = None
+    unsaved_logs = False
     
     try:
         control_conn = get_control_connection()
         staging_engine = get_staging_engine()
         
         try:
-            all_files = os.listdir(RAW_DATA_DIR)
-            csv_files = {f for f in all_files if f.startswith('states_') and f.endswith('.csv')}
+            # Lấy luôn kích thước file trong cùng lần quét để sắp xếp, không cần stat lại
+            with os.scandir(RAW_DATA_DIR) as entries:
+                csv_files = {
+                    e.name: e.stat().st_size for e in entries
+                    if e.name.startswith('states_') and e.name.endswith('.csv') and e.is_file()
+                }
         except FileNotFoundError:
             print(f"LỖI: Không tìm thấy thư mục {RAW_DATA_DIR}")
             return
@@ -182,7 +435,7 @@ def main():
             return
 
         processed = get_processed_files(control_conn)
-        new_files = list(csv_files - processed)
+        new_files = list(csv_files.keys() - processed)
         
         register_new_files(control_conn, new_files)
         
@@ -190,21 +443,42 @@ def main():
         with control_conn.cursor() as cur:
             cur.execute("SELECT file_name FROM file_log WHERE status = 'NEW'")
             files_to_run = [r[0] for r in cur.fetchall()]
+        
+        # File lớn nhất chạy trước (LPT) để các worker kết thúc gần nhau hơn
+        files_to_run.sort(key=lambda f: csv_files.get(f, 0), reverse=True)
             
         print(f"Tìm thấy {len(files_to_run)} file cần xử lý.")
         
-        for fname in files_to_run:
-            try:
-                update_file_log(control_conn, fname, 'PROCESSING')
-                
-                rows = process_single_file(fname, staging_engine)
-                
-                update_file_log(control_conn, fname, 'CLEAN_EXPORTED', row_count=rows)
-                print(f"✅ Hoàn tất file {fname}. Tổng dòng: {rows}")
+        # control_conn chỉ dùng ở luồng chính; các worker chỉ dùng pool của staging_engine
+        stream_to_warehouse = load_etl_flag('stream_to_warehouse')
+        done_status = 'WAREHOUSE_LOADED' if stream_to_warehouse else 'CLEAN_EXPORTED'
+        log_buffer = FileLogBuffer(control_conn)
+        try:
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                futures = {}
+                for fname in files_to_run:
+                    futures[executor.submit(load_file, fname, staging_engine, stream_to_warehouse)] = fname
                 
-            except Exception as e:
-                print(f"❌ LỖI file {fname}: {e}")
-                update_file_log(control_conn, fname, 'FAILED', msg=str(e))
+                for future in as_completed(futures):
+                    fname = futures[future]
+                    try:
+                        rows = future.result()
+                        if rows is None:
+                            print(f"Bỏ qua file {fname}: đã được tiến trình khác nhận xử lý.")
+                            continue
+                        
+                        log_buffer.add(fname, done_status, row_count=rows)
+                        print(f"✅ Hoàn tất file {fname}. Tổng dòng: {rows}")
+                        
+                    except FileClaimError as e:
+                        print(f"❌ LỖI nhận file {fname} (không cập nhật file_log): {e}")
+                    except Exception as e:
+                        print(f"❌ LỖI file {fname}: {e}")
+                        log_buffer.add(fname, 'FAILED', msg=str(e))
+        finally:
+            if not log_buffer.flush():
+                log_buffer.report_unsaved()
+                unsaved_logs = True
 
     except Exception as e:
         print(f"Lỗi hệ thống: {e}")
@@ -213,6 +487,8 @@ def main():
         if staging_engine: staging_engine.dispose()
 
     print("--- Kết thúc quy trình ---")
+    if unsaved_logs:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
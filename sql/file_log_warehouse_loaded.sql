@@ -0,0 +1,41 @@
+-- Cho phép file_log.status = 'WAREHOUSE_LOADED' (file đã nạp thẳng vào db_warehouse,
+-- không có DataStaging/clean_*.csv để bước load warehouse đọc lại).
+-- Chạy 1 lần trên db_control trước khi bật [etl] stream_to_warehouse = true.
+-- Không làm gì nếu status là cột text/varchar không ràng buộc.
+
+DO $$
+DECLARE
+    status_type regtype;
+    con record;
+    allowed text[];
+BEGIN
+    SELECT a.atttypid::regtype INTO status_type
+    FROM pg_attribute a
+    WHERE a.attrelid = 'file_log'::regclass AND a.attname = 'status' AND NOT a.attisdropped;
+
+    -- Cột status kiểu ENUM
+    IF EXISTS (SELECT 1 FROM pg_type WHERE oid = status_type AND typtype = 'e') THEN
+        EXECUTE format('ALTER TYPE %s ADD VALUE IF NOT EXISTS %L', status_type, 'WAREHOUSE_LOADED');
+    END IF;
+
+    -- CHECK constraint liệt kê các giá trị status: tạo lại với thêm 'WAREHOUSE_LOADED'
+    FOR con IN
+        SELECT c.conname, pg_get_constraintdef(c.oid) AS def
+        FROM pg_constraint c
+        WHERE c.conrelid = 'file_log'::regclass
+          AND c.contype = 'c'
+          AND pg_get_constraintdef(c.oid) LIKE '%status%'
+          AND pg_get_constraintdef(c.oid) NOT LIKE '%WAREHOUSE_LOADED%'
+    LOOP
+        SELECT array_agg(DISTINCT m[1]) INTO allowed
+        FROM regexp_matches(con.def, '''([^'']*)''', 'g') AS m;
+        allowed := array_append(allowed, 'WAREHOUSE_LOADED');
+
+        EXECUTE format('ALTER TABLE file_log DROP CONSTRAINT %I', con.conname);
+        EXECUTE format(
+            'ALTER TABLE file_log ADD CONSTRAINT %I CHECK (status IN (%s))',
+            con.conname,
+            (SELECT string_agg(quote_literal(v), ', ') FROM unnest(allowed) AS v)
+        );
+    END LOOP;
+END $$;